@@ -0,0 +1,123 @@
+"""
+Optional compiled kernels for computing sampled detector statistics
+
+If :term:`numba` is installed, :func:`sampleStatistics` computes the
+mean, relative uncertainty, and deviation in a single pass over the
+sampled data. Otherwise callers should fall back to the pure
+:term:`numpy` implementation. :term:`numba` is only imported, and the
+kernel only compiled, the first time :func:`sampleStatistics` is called.
+"""
+from math import sqrt
+from importlib.util import find_spec
+
+from numpy import empty, zeros, float64
+
+HAS_NUMBA = find_spec("numba") is not None
+
+# Replaced with numba.prange when the kernel is compiled
+prange = range
+
+__all__ = ["HAS_NUMBA", "MIN_COMPILED_BINS", "sampleStatistics"]
+
+# Minimum number of bins in a single detector before the compiled
+# kernel is used. Smaller detectors are handled quickly by numpy,
+# and would not recover the cost of compiling the kernel
+MIN_COMPILED_BINS = 100000
+
+# Number of bins processed together by each thread. Small enough
+# that the running sums for a block stay in cache
+BLOCK_SIZE = 2048
+
+
+def _blockStatistics(tallies, errors, mean, relErr, deviation):
+    """
+    Compute statistics for all bins across all sampled detectors
+
+    Bins are split into blocks that are processed in parallel. Within
+    a block, samples are visited in the outer loop so that tallies
+    and errors are read with unit stride.
+
+    Parameters
+    ----------
+    tallies : numpy.ndarray
+        Two dimensional array of tally data, where the first dimension
+        is the sample index and the second is the flattened bin index
+    errors : numpy.ndarray
+        Absolute uncertainties with the same structure as ``tallies``
+    mean : numpy.ndarray
+        Vector to be filled with the average tally in each bin
+    relErr : numpy.ndarray
+        Vector to be filled with the relative uncertainty on the
+        average, assuming no covariance between samples
+    deviation : numpy.ndarray
+        Vector to be filled with the deviation in tallies
+
+    """
+    nFiles, nBins = tallies.shape
+    nBlocks = (nBins + BLOCK_SIZE - 1) // BLOCK_SIZE
+    for block in prange(nBlocks):
+        start = block * BLOCK_SIZE
+        stop = min(start + BLOCK_SIZE, nBins)
+        total = zeros(stop - start)
+        squares = zeros(stop - start)
+        errSquares = zeros(stop - start)
+        for ix in range(nFiles):
+            row = tallies[ix, start:stop]
+            err = errors[ix, start:stop]
+            for jx in range(stop - start):
+                value = row[jx]
+                total[jx] += value
+                squares[jx] += value * value
+                errSquares[jx] += err[jx] * err[jx]
+        for jx in range(stop - start):
+            avg = total[jx] / nFiles
+            mean[start + jx] = avg
+            variance = squares[jx] / nFiles - avg * avg
+            deviation[start + jx] = sqrt(variance) if variance > 0 else 0.0
+            absErr = sqrt(errSquares[jx]) / nFiles
+            relErr[start + jx] = absErr / avg if avg != 0 else absErr
+
+
+_compiledStatistics = None
+
+
+def _compile():
+    """Import :term:`numba` and compile the statistics kernel"""
+    global _compiledStatistics, prange
+    from numba import njit, prange
+    _compiledStatistics = njit(parallel=True, cache=True)(_blockStatistics)
+    return _compiledStatistics
+
+
+def sampleStatistics(allTallies, allErrors):
+    """
+    Compute the mean, relative error, and deviation of sampled data
+
+    Requires :term:`numba`, which can be checked with ``HAS_NUMBA``.
+
+    Parameters
+    ----------
+    allTallies : numpy.ndarray
+        Tally data where the first dimension is the sample index
+    allErrors : numpy.ndarray
+        Absolute uncertainties with the same structure as
+        ``allTallies``
+
+    Returns
+    -------
+    tallies : numpy.ndarray
+        Average tally data
+    errors : numpy.ndarray
+        Relative uncertainty on the average, assuming no covariance
+    deviation : numpy.ndarray
+        Deviation in tallies across all samples
+
+    """
+    kernel = _compiledStatistics or _compile()
+    shape = allTallies.shape[1:]
+    nFiles = allTallies.shape[0]
+    outputs = [empty(shape, dtype=float64) for _ in range(3)]
+    kernel(
+        allTallies.reshape(nFiles, -1), allErrors.reshape(nFiles, -1),
+        *[out.reshape(-1) for out in outputs])
+    return tuple(outputs)
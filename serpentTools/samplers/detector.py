@@ -2,16 +2,57 @@
 Class to read and process a batch of similar detector files
 """
 from collections import defaultdict
+from numbers import Real
 import warnings
 
-from numpy import empty, square, sqrt, allclose, asarray
+from numpy import (
+    empty, copyto, sqrt, asarray, einsum, maximum, divide,
+    stack, multiply, promote_types, float32, float64, zeros,
+    allclose, ndarray, dtype as numpyDtype,
+)
 from matplotlib import pyplot
+from matplotlib.collections import LineCollection
 
 from serpentTools.messages import SerpentToolsException
 from serpentTools.utils import magicPlotDocDecorator, formatPlot
 from serpentTools.parsers.detector import DetectorReader
 from serpentTools.detectors import Detector
 from serpentTools.samplers.base import Sampler
+from serpentTools.samplers._detector_kernels import (
+    HAS_NUMBA, sampleStatistics, MIN_COMPILED_BINS,
+)
+
+# Tolerances for declaring grids equal, mirroring numpy.allclose
+GRID_RTOL = 1E-5
+GRID_ATOL = 1E-8
+
+# Sampled data buffers that can be reused, keyed by shape and data type
+_BUFFER_POOL = {}
+# Maximum number of buffers retained for a given shape and data type
+MAX_POOLED_BUFFERS = 4
+# Maximum number of shape and data type combinations retained
+MAX_POOLED_SHAPES = 4
+
+
+def _takeBuffer(shape, dtype):
+    """Return an uninitialized array, reusing a pooled array if possible"""
+    pool = _BUFFER_POOL.get((shape, numpyDtype(dtype)))
+    if pool:
+        return pool.pop()
+    return empty(shape, dtype=dtype)
+
+
+def _returnBuffer(buffer):
+    """Place an array into the pool for reuse if there is room"""
+    key = buffer.shape, buffer.dtype
+    if key not in _BUFFER_POOL:
+        # Discard the oldest shapes to make room
+        while len(_BUFFER_POOL) >= MAX_POOLED_SHAPES:
+            del _BUFFER_POOL[next(iter(_BUFFER_POOL))]
+        _BUFFER_POOL[key] = []
+    pool = _BUFFER_POOL[key]
+    if len(pool) < MAX_POOLED_BUFFERS:
+        pool.append(buffer)
 
 
 class DetectorSampler(Sampler):
@@ -63,42 +104,65 @@ class DetectorSampler(Sampler):
         self._checkSizes()
 
     def _checkSizes(self):
-        sizes = None
+        sizes = defaultdict(lambda: defaultdict(set))
         for parser in self.parsers:
-            if sizes is None:
-                sizes = {det: {} for det in parser.detectors}
             for detName, det in parser.detectors.items():
-                level = sizes[detName]
-                shape = det.tallies.shape
-                if shape not in level:
-                    level[shape] = {parser.filePath}
-                else:
-                    level[shape].add(parser.filePath)
+                sizes[detName][det.tallies.shape].add(parser.filePath)
         for detName, misMatches in sizes.items():
             if len(misMatches) > 1:
                 self._raiseErrorMsgFromDict(misMatches, 'shape', 'detector')
 
     def _process(self):
-        individualDetectors = defaultdict(list)
-        for parser in self:
+        nParsers = len(self)
+        # Preserve the order in which detectors appear in the files
+        detNames = dict.fromkeys(
+            name for parser in self for name in parser.detectors)
+        individualDetectors = {name: [None] * nParsers for name in detNames}
+        for ix, parser in enumerate(self):
             for detName, detector in parser.items():
-                individualDetectors[detName].append(detector)
+                individualDetectors[detName][ix] = detector
         for name, detList in individualDetectors.items():
+            # Some files may be missing detectors if the precheck is skipped
+            if None in detList:
+                detList = [d for d in detList if d is not None]
             self.detectors[name] = SampledDetector.fromDetectors(
                 name, detList)
 
-    def _free(self):
+    def free(self, recycle=False):
+        """Remove all parsers and individual containers from memory
+
+        Parameters
+        ----------
+        recycle : bool, optional
+            If ``True``, keep the sampled data arrays of each detector
+            for reuse by later samplers with detectors of the same
+            shape. Useful when many samplers are created in sequence,
+            e.g. for parameter sweeps. See
+            :meth:`SampledDetector.free` and
+            :meth:`SampledDetector.clearBufferPool`
+        """
+        self._free(recycle)
+        self.parsers = set()
+        self.map = {}
+
+    def _free(self, recycle=False):
         for sampledDet in self.detectors.values():
-            sampledDet.free()
+            sampledDet.free(recycle=recycle)
 
     def iterDets(self):
-        for name, detector in self.detectors.items():
-            yield name, detector
+        """Iterate over detector names and sampled detectors"""
+        return iter(self.detectors.items())
 
 
 class SampledDetector(Detector):
     """Class to store aggregated detector data
 
+    .. note::
+
+        :attr:`tallies`, :attr:`errors`, and :attr:`deviation` are
+        computed from :attr:`allTallies` and :attr:`allErrors` the
+        first time any of them is accessed
+
     Parameters
     ----------
     name : str
@@ -152,19 +216,117 @@ class SampledDetector(Detector):
         # average tally data, propagate uncertainty
         self._allTallies = allTallies
         self._allErrors = allErrors
-        tallies = self.allTallies.mean(axis=0)
+        self._deviation = None
+        # Buffers allocated by fromDetectors that can be recycled
+        self._pooled = ()
 
-        # propagate absolute uncertainty
-        # assume no covariance
-        inner = square(allErrors).sum(axis=0)
-        errors = sqrt(inner) / allTallies.shape[0]
-        nz = tallies.nonzero()
-        errors[nz] /= tallies[nz]
+        # tallies, errors, and deviation are computed on first access
+        Detector.__init__(self, name, grids=grids, indexes=indexes)
 
-        Detector.__init__(self, name, tallies=tallies, errors=errors,
-                          grids=grids, indexes=indexes)
+    def free(self, recycle=False):
+        """Release :attr:`allTallies` and :attr:`allErrors`
 
-        self._deviation = None
+        Averaged tallies, errors, and deviation are computed prior
+        to releasing the sampled data.
+
+        Parameters
+        ----------
+        recycle : bool, optional
+            If ``True``, arrays allocated by :meth:`fromDetectors` are
+            kept for reuse by later detectors of the same shape. This
+            takes ownership of the arrays: any references to
+            :attr:`allTallies` or :attr:`allErrors` held elsewhere
+            may be overwritten and should not be used. Otherwise the
+            arrays are simply released.
+
+        See Also
+        --------
+        :meth:`clearBufferPool`
+        """
+        if self._allTallies is not None and (
+                self._tallies is None or self._deviation is None
+                or (self._errors is None and self._allErrors is not None)):
+            self._aggregate()
+        if recycle:
+            for buffer in (self._allTallies, self._allErrors):
+                if any(buffer is pooled for pooled in self._pooled):
+                    _returnBuffer(buffer)
+        self._pooled = ()
+        self._allTallies = None
+        self._allErrors = None
+
+    @staticmethod
+    def clearBufferPool():
+        """Release all arrays kept for reuse by :meth:`free`"""
+        _BUFFER_POOL.clear()
+
+    def _aggregate(self):
+        """Average tallies and propagate uncertainties from all samples"""
+        if self._allErrors is None:
+            tallies, deviation = _meanAndDeviation(self._allTallies)
+            errors = None
+        else:
+            tallies, errors, deviation = _computeStatistics(
+                self._allTallies, self._allErrors)
+        # Do not overwrite quantities that have been set directly
+        if self._tallies is None:
+            self._tallies = tallies
+        if self._errors is None:
+            self._errors = errors
+        if self._deviation is None:
+            self._deviation = deviation
+
+    @Detector.tallies.getter
+    def tallies(self):
+        if self._tallies is None and self._allTallies is not None:
+            self._aggregate()
+        return self._tallies
+
+    @Detector.errors.getter
+    def errors(self):
+        if (self._errors is None and self._allTallies is not None
+                and self._allErrors is not None):
+            self._aggregate()
+        return self._errors
+
+    @tallies.setter
+    def tallies(self, tallies):
+        if self._tallies is None:
+            self._checkAgainstSamples(tallies, "tallies")
+        Detector.tallies.fset(self, tallies)
+
+    @errors.setter
+    def errors(self, errors):
+        if self._errors is None:
+            self._checkAgainstSamples(errors, "errors")
+        Detector.errors.fset(self, errors)
+
+    def _checkAgainstSamples(self, value, qty):
+        """Check the shape of data set before statistics are computed"""
+        if value is None or self._allTallies is None:
+            return
+        expected = self._allTallies.shape[1:]
+        if isinstance(value, Real):
+            if expected:
+                raise TypeError(
+                    "Sampled {} are arrays, not scalar".format(qty))
+        elif isinstance(value, ndarray) and value.shape != expected:
+            raise IndexError(
+                "Shape of {} is not consistent with sampled data. Should "
+                "be {}, is {}".format(qty, expected, value.shape))
+
+    @Detector.indexes.setter
+    def indexes(self, ix):
+        # Check against sampled data if tallies have not been computed
+        if self._tallies is None and self._allTallies is not None:
+            nItems = len(self._allTallies.shape) - 1
+            if len(ix) != nItems:
+                raise ValueError(
+                    "Expected {} items for indexes, got {}".format(
+                        nItems, len(ix)))
+            self._indexes = tuple(ix)
+            return
+        Detector.indexes.fset(self, ix)
 
     @property
     def allTallies(self):
@@ -176,7 +338,8 @@ class SampledDetector(Detector):
             self._allTallies = None
             return
 
-        tallies = asarray(tallies)
+        if not isinstance(tallies, ndarray):
+            tallies = asarray(tallies)
 
         if self._allTallies is None:
             self._allTallies = tallies
@@ -198,7 +361,8 @@ class SampledDetector(Detector):
             self._allErrors = None
             return
 
-        errors = asarray(errors)
+        if not isinstance(errors, ndarray):
+            errors = asarray(errors)
 
         if self._allErrors is None:
             self._allErrors = errors
@@ -212,10 +376,13 @@ class SampledDetector(Detector):
 
     @property
     def deviation(self):
+        if (self._deviation is None and self._tallies is None
+                and self._allTallies is not None):
+            self._aggregate()
         if self._deviation is not None:
             return self._deviation
         if self.allTallies is not None:
-            return self.allTallies.std(axis=0)
+            return _meanAndDeviation(self.allTallies)[1]
         return None
 
     @deviation.setter
@@ -225,10 +392,11 @@ class SampledDetector(Detector):
             return
 
         dev = asarray(dev)
-        if self.deviation is not None and dev.shape != self.deviation.shape:
+        if (self._deviation is not None
+                and dev.shape != self._deviation.shape):
             raise ValueError(
                 "Deviation shape should be {}, is {}".format(
-                    self.deviation.shape, dev.shape))
+                    self._deviation.shape, dev.shape))
         elif self.tallies is not None and dev.shape != self.tallies.shape:
             raise ValueError(
                 "Deviation shape {} incompatible with tally shape {}"
@@ -257,7 +425,10 @@ class SampledDetector(Detector):
         sampleKwargs : dict, optional
             Additional matplotlib-acceptable arguments to be passed into the
             plot when plotting data from unique runs, e.g.
-            ``{"c": k, "alpha": 0.5}``.
+            ``{"c": k, "alpha": 0.5}``. Samples are drawn as a single
+            :class:`matplotlib.collections.LineCollection` unless
+            options only supported for individual lines, like markers,
+            are given.
         meanKwargs : dict, optional
             Additional matplotlib-acceptable argumentst to be used when
             plotting the mean value, e.g. ``{"c": "b", "marker": "o"}``
@@ -292,9 +463,22 @@ class SampledDetector(Detector):
         if meanKwargs is None:
             meanKwargs = {"c": "#0173b2", "marker": "o"}
 
+        # Slice all samples at once and draw every sample in one call
+        sampled = self.allTallies[(slice(None), ) + slices]
+
         ax = ax or pyplot.gca()
-        for data in self.allTallies:
-            ax.plot(xdata, data[slices], **sampleKwargs)
+        segments = empty(sampled.shape + (2, ))
+        segments[..., 0] = xdata
+        segments[..., 1] = sampled
+        try:
+            samples = LineCollection(
+                segments, **_lineCollectionKwargs(sampleKwargs))
+        except AttributeError:
+            # Options like markers are only supported by Line2D
+            ax.plot(xdata, sampled.T, **sampleKwargs)
+        else:
+            ax.add_collection(samples)
+            ax.autoscale_view()
 
         ax.plot(xdata, samplerData, label='Mean value', **meanKwargs)
         formatPlot(ax, logx=logx, logy=logy, loglog=loglog, xlabel=xlabel,
@@ -302,7 +486,8 @@ class SampledDetector(Detector):
         return ax
 
     @classmethod
-    def fromDetectors(cls, name, detectors):
+    def fromDetectors(cls, name, detectors, dtype=None,
+                      takeOwnership=False):
         """
         Create a :class:`SampledDetector` from similar detectors
 
@@ -314,6 +499,18 @@ class SampledDetector(Detector):
             Iterable that contains detectors to be averaged. These
             should be structured identically, in shape of the tally
             data and the underlying grids and indexes.
+        dtype : numpy.dtype, optional
+            Data type used to store :attr:`allTallies` and
+            :attr:`allErrors`. Defaults to the type of the first
+            detector's tallies, promoted to at least single precision.
+            Passing ``numpy.float32`` halves the memory required for
+            large detectors, while statistics are still accumulated
+            in double precision.
+        takeOwnership : bool, optional
+            If ``True``, the ``tallies`` and ``errors`` of each
+            incoming detector are set to ``None`` once copied,
+            allowing their memory to be reclaimed during construction.
+            The incoming detectors should not be used afterwards.
 
         Returns
         -------
@@ -324,66 +521,301 @@ class SampledDetector(Detector):
         TypeError
             If something other than a :class:`serpentTools.Detector` is found
         ValueError
-            If tally data are not shaped consistently
+            If tally data are not shaped consistently, or no detectors
+            are given
         KeyError
             If some grid or index information is missing
         AttributeError
             If one detector is missing grids entirely but grids are
             present on other grids
         """
-        shape = None
-        indexes = None
-        grids = {}
-        differentGrids = set()
-
+        detectors = tuple(detectors)
         for d in detectors:
             if not isinstance(d, Detector):
                 raise TypeError(
                     "All items should be Detector. Found {}".format(type(d)))
+        if not detectors:
+            raise ValueError("Need at least one detector to sample")
 
-            if shape is None:
-                shape = d.tallies.shape
-            elif shape != d.tallies.shape:
-                raise ValueError(
-                    "Shapes do not agree. Found {} and {}".format(
-                        shape, d.tallies.shape))
+        shapes = {d.tallies.shape for d in detectors}
+        if len(shapes) != 1:
+            raise ValueError(
+                "Shapes do not agree. Found {}".format(
+                    ", ".join(str(s) for s in shapes)))
+
+        # Inspect tally structure via indexes
+        indexes = detectors[0].indexes
+        for d in detectors:
+            if d.indexes != indexes:
+                raise KeyError(
+                    "Detector indexes do not agree. Found {} and "
+                    "{}".format(d.indexes, indexes))
+
+        # Inspect tally structure via grids
+        grids = detectors[0].grids
+        differentGrids = set()
+        # Detectors sharing the same grid dictionary need no checks
+        if any(d.grids is not grids for d in detectors):
+            differentGrids = _compareGrids(detectors)
+
+        _warnDifferentGrids(differentGrids)
+
+        # Write directly into the aggregate arrays to avoid holding
+        # intermediate copies of every detector
+        if dtype is None:
+            dtype = promote_types(detectors[0].tallies.dtype, float32)
+        shape = (len(detectors), ) + shapes.pop()
+        allTallies = _takeBuffer(shape, dtype)
+        allErrors = _takeBuffer(shape, dtype)
+
+        for ix, d in enumerate(detectors):
+            copyto(allTallies[ix], d.tallies)
+            multiply(d.tallies, d.errors, out=allErrors[ix])
+            if takeOwnership:
+                d._tallies = d._errors = None
+
+        sampled = cls(name, allTallies, allErrors, indexes=indexes,
+                      grids=grids)
+        sampled._pooled = (allTallies, allErrors)
+        return sampled
+
+    @classmethod
+    def fromDetectorsStreaming(cls, name, detectors):
+        """
+        Create a :class:`SampledDetector` without storing all tally data
+
+        Averages, deviations, and uncertainties are updated as each
+        detector is consumed, so memory does not grow with the number
+        of detectors. As a consequence, :attr:`allTallies` and
+        :attr:`allErrors` are ``None`` and :meth:`spreadPlot` cannot
+        be used.
+
+        Parameters
+        ----------
+        name : str
+            Name of this detector
+        detectors : iterable of :class:`serpentTools.Detector`
+            Iterable that contains detectors to be averaged. May be a
+            generator that reads detectors one at a time. These
+            should be structured identically, in shape of the tally
+            data and the underlying grids and indexes.
 
-            # Inspect tally structure via indexes
-            if indexes is None and d.indexes is not None:
-                indexes = d.indexes
+        Returns
+        -------
+        SampledDetector
+
+        Raises
+        ------
+        TypeError
+            If something other than a :class:`serpentTools.Detector` is found
+        ValueError
+            If tally data are not shaped consistently, or no detectors
+            are given
+        KeyError
+            If some grid or index information is missing
+        AttributeError
+            If one detector is missing grids entirely but grids are
+            present on other grids
+
+        See Also
+        --------
+        :meth:`fromDetectors`
+        """
+        ref = None
+        differentGrids = set()
+
+        for nFiles, d in enumerate(detectors, start=1):
+            if not isinstance(d, Detector):
+                raise TypeError(
+                    "All items should be Detector. Found {}".format(type(d)))
+
+            if ref is None:
+                ref = d
+                mean = zeros(d.tallies.shape)
+                sumDiffSquares = zeros(d.tallies.shape)
+                errSquares = zeros(d.tallies.shape)
+                work = empty(d.tallies.shape)
             else:
-                if d.indexes != indexes:
+                if d.tallies.shape != ref.tallies.shape:
+                    raise ValueError(
+                        "Shapes do not agree. Found {} and {}".format(
+                            ref.tallies.shape, d.tallies.shape))
+                if d.indexes != ref.indexes:
                     raise KeyError(
                         "Detector indexes do not agree. Found {} and "
-                        "{}".format(d.indexes, indexes))
-
-            # Inspect tally structure via grids
-            if d.grids and not grids:
-                grids = d.grids
-            elif not d.grids and grids:
-                raise AttributeError(
-                    "Detector {} is missing grid structure".format(d))
-            elif d.grids and grids:
-                for key, refGrid in grids.items():
-                    thisGrid = d.grids.get(key)
-                    if thisGrid is None:
-                        raise KeyError(
-                            "Detector {} is missing {} grid".format(d, key))
-                    if not allclose(refGrid, thisGrid):
+                        "{}".format(d.indexes, ref.indexes))
+                _checkGridStructure(ref, d)
+                for key, refGrid in ref.grids.items():
+                    if not _gridsClose(d.grids[key], refGrid):
                         differentGrids.add(key)
 
-        if differentGrids:
-            warnings.warn(
-                "Found some potentially different grids {}".format(
-                    ", ".join(differentGrids)), RuntimeWarning)
+            # Welford update of the mean and sum of squared differences
+            delta = d.tallies - mean
+            mean += delta / nFiles
+            sumDiffSquares += delta * (d.tallies - mean)
+            _addSquaredError(errSquares, d.tallies, d.errors, work)
 
-        shape = (len(detectors), ) + shape
+        if ref is None:
+            raise ValueError("Need at least one detector to sample")
 
-        allTallies = empty(shape)
-        allErrors = empty(shape)
+        _warnDifferentGrids(differentGrids)
 
-        for ix, d in enumerate(detectors):
-            allTallies[ix] = d.tallies
-            allErrors[ix] = d.tallies * d.errors
+        errors = _relativeErrors(errSquares, nFiles, mean)
+
+        sampled = cls(name, None, None, grids=ref.grids)
+        sampled.tallies = mean
+        sampled.errors = errors
+        sampled.deviation = sqrt(sumDiffSquares / nFiles)
+        if ref.indexes is not None:
+            sampled.indexes = ref.indexes
+        return sampled
+
+
+def _lineCollectionKwargs(lineKwargs):
+    """Convert plot options for Line2D to those for a LineCollection"""
+    kwargs = dict(lineKwargs)
+    if "c" in kwargs:
+        kwargs["color"] = kwargs.pop("c")
+    if kwargs.get("marker", None) in {"", None, "None", "none"}:
+        kwargs.pop("marker", None)
+    return kwargs
+
+
+def _computeStatistics(allTallies, allErrors):
+    """
+    Average sampled tallies and propagate uncertainties
+
+    Parameters
+    ----------
+    allTallies : numpy.ndarray
+        Tally data where the first dimension is the sample index
+    allErrors : numpy.ndarray
+        Absolute uncertainties with the same structure as ``allTallies``
 
-        return cls(name, allTallies, allErrors, indexes=indexes, grids=grids)
+    Returns
+    -------
+    tallies : numpy.ndarray
+        Average tally data
+    errors : numpy.ndarray
+        Relative uncertainty on the average, assuming no covariance
+    deviation : numpy.ndarray
+        Deviation in tallies across all samples
+
+    """
+    if (HAS_NUMBA
+            and allTallies[0].size >= MIN_COMPILED_BINS
+            and allTallies.dtype == float64
+            and allErrors.dtype == float64):
+        return sampleStatistics(allTallies, allErrors)
+
+    nFiles = allTallies.shape[0]
+    tallies, deviation = _meanAndDeviation(allTallies)
+
+    inner = einsum("i...,i...->...", allErrors, allErrors, dtype=float64)
+    errors = _relativeErrors(inner, nFiles, tallies)
+
+    return tallies, errors, deviation
+
+
+def _relativeErrors(errSquares, nFiles, tallies):
+    """Propagate absolute uncertainties to relative error on the mean
+
+    Assumes no covariance between samples. Bins with zero tallies are
+    left as absolute uncertainties. The division is masked rather than
+    using fancy indexing on the non-zero bins, so no index arrays are
+    created.
+    """
+    errors = sqrt(errSquares)
+    errors /= nFiles
+    divide(errors, tallies, out=errors, where=tallies != 0)
+    return errors
+
+
+def _meanAndDeviation(allTallies):
+    """Return the average and deviation along the first axis
+
+    The sum of squares is reused for the deviation, rather than
+    making another pass through ``allTallies`` with ``std``.
+    Values are accumulated in double precision in case data are
+    stored with a smaller type.
+    """
+    nFiles = allTallies.shape[0]
+    tallies = allTallies.sum(axis=0, dtype=float64) / nFiles
+    sumSquares = einsum("i...,i...->...", allTallies, allTallies,
+                        dtype=float64)
+    deviation = sqrt(maximum(sumSquares / nFiles - tallies * tallies, 0.0))
+    return tallies, deviation
+
+
+def _addSquaredError(errSquares, tallies, relErrors, work):
+    """Add squared absolute errors to ``errSquares`` in place
+
+    ``work`` is a scratch array shaped like ``tallies`` so no
+    temporary arrays are created.
+    """
+    multiply(tallies, relErrors, out=work)
+    multiply(work, work, out=work)
+    errSquares += work
+
+
+def _compareGrids(detectors):
+    """Return names of grids that differ across detectors
+
+    Raises
+    ------
+    AttributeError
+        If some detectors have grids and others do not
+    KeyError
+        If some detectors are missing grids found on the first detector
+    """
+    ref = detectors[0]
+    for d in detectors:
+        _checkGridStructure(ref, d)
+
+    # Compare each grid across all detectors at once
+    differentGrids = set()
+    for key, refGrid in ref.grids.items():
+        thisGrid = [d.grids[key] for d in detectors]
+        # Shared arrays are trivially equal
+        if all(g is refGrid for g in thisGrid):
+            continue
+        if len({g.shape for g in thisGrid}) != 1:
+            differentGrids.add(key)
+            continue
+        if not _gridsClose(stack(thisGrid), refGrid):
+            differentGrids.add(key)
+    return differentGrids
+
+
+def _checkGridStructure(ref, detector):
+    """Ensure a detector has the same grids as a reference detector
+
+    Raises
+    ------
+    AttributeError
+        If only one of the detectors has grids
+    KeyError
+        If ``detector`` is missing grids found on ``ref``
+    """
+    if bool(detector.grids) != bool(ref.grids):
+        raise AttributeError(
+            "Detector {} is missing grid structure".format(
+                detector if ref.grids else ref))
+    missing = set(ref.grids).difference(detector.grids)
+    if missing:
+        raise KeyError("Detector {} is missing {} grid".format(
+            detector, ", ".join(sorted(missing))))
+
+
+def _gridsClose(grids, refGrid):
+    """Return True if one or more stacked grids agree with a reference"""
+    if grids.shape[grids.ndim - refGrid.ndim:] != refGrid.shape:
+        return False
+    return allclose(grids, refGrid, rtol=GRID_RTOL, atol=GRID_ATOL)
+
+
+def _warnDifferentGrids(differentGrids):
+    if differentGrids:
+        warnings.warn(
+            "Found some potentially different grids {}".format(
+                ", ".join(sorted(differentGrids))), RuntimeWarning)
@@ -21,14 +21,24 @@ File Descriptions
     tolerance can still be achieved.
 
 """
-from numpy import square, sqrt
+import sys
+import subprocess
+import warnings
+
+import pytest
+from numpy import square, sqrt, float32
+from numpy.random import RandomState
 from numpy.testing import assert_allclose
 from serpentTools.messages import MismatchedContainersError
 from serpentTools.data import getFile
+from serpentTools.detectors import Detector
 from serpentTools.parsers.detector import DetectorReader
-from serpentTools.samplers.detector import DetectorSampler
+from serpentTools.samplers.detector import DetectorSampler, SampledDetector
+from serpentTools.samplers import _detector_kernels
+from serpentTools.samplers import detector as detectorModule
+from serpentTools.settings import rc
 
-from tests import TestCaseWithLogCapture
+from tests import TestCaseWithLogCapture, plotTest
 
 _DET_FILES = {
     'bwr0': 'bwr_0',
@@ -83,6 +93,132 @@ class DetSamplerTester(TestCaseWithLogCapture):
             assert_allclose(uniq.errors, expectedErrors, err_msg='errrors',
                             **TOLERANCES['errors'])
 
+    def test_deviation(self):
+        """Validate the deviation across sampled tallies"""
+        for detName, uniq in self.sampler.detectors.items():
+            assert_allclose(uniq.deviation, uniq.allTallies.std(axis=0),
+                            rtol=1E-6, atol=1E-16, err_msg=detName)
+
+    def test_deviationFromAllTallies(self):
+        """Verify the deviation is recomputed if cleared"""
+        sampled = SampledDetector(
+            'test', self.sampler['spectrum'].allTallies.copy(),
+            self.sampler['spectrum'].allErrors.copy())
+        expected = sampled.allTallies.std(axis=0)
+        self.assertIsNotNone(sampled.tallies)
+        sampled.deviation = None
+        assert_allclose(sampled.deviation, expected, rtol=1E-6)
+        sampled.allTallies = None
+        self.assertIsNone(sampled.deviation)
+
+    def test_lazyStatistics(self):
+        """Verify statistics are only computed when requested"""
+        ref = self.sampler['spectrum']
+        sampled = SampledDetector(
+            'test', ref.allTallies, ref.allErrors, indexes=ref.indexes,
+            grids=ref.grids)
+        self.assertIsNone(sampled._tallies)
+        self.assertIsNone(sampled._errors)
+        self.assertIsNone(sampled._deviation)
+        assert_allclose(sampled.errors, ref.errors)
+        self.assertIsNotNone(sampled._tallies)
+        self.assertIsNotNone(sampled._deviation)
+        assert_allclose(sampled.tallies, ref.tallies)
+
+    @plotTest
+    def test_spreadPlot(self):
+        """Verify all sampled tallies and the mean are plotted"""
+        det = self.sampler['xymesh']
+        fixed = {'ymesh': 0, 'energy': 0}
+        ax = det.spreadPlot(xdim='xmesh', fixed=fixed)
+        self.assertEqual(len(ax.collections), 1)
+        segments = ax.collections[0].get_segments()
+        self.assertEqual(len(segments), det.allTallies.shape[0])
+        for ix, segment in enumerate(segments):
+            assert_allclose(segment[:, 1], det.allTallies[ix, 0, 0])
+        lines = ax.get_lines()
+        self.assertEqual(len(lines), 1)
+        assert_allclose(lines[0].get_ydata(), det.tallies[0, 0])
+
+    @plotTest
+    def test_spreadPlotMarkers(self):
+        """Verify samples with markers are plotted as lines"""
+        det = self.sampler['xymesh']
+        ax = det.spreadPlot(xdim='xmesh', fixed={'ymesh': 0, 'energy': 0},
+                            sampleKwargs={'c': 'r', 'marker': 'x'})
+        self.assertEqual(len(ax.collections), 0)
+        lines = ax.get_lines()
+        self.assertEqual(len(lines), det.allTallies.shape[0] + 1)
+        for ix, line in enumerate(lines[:-1]):
+            assert_allclose(line.get_ydata(), det.allTallies[ix, 0, 0])
+
+    def test_freeAll(self):
+        """Verify averages are retained if the sampler frees all data"""
+        with rc:
+            rc['sampler.freeAll'] = True
+            sampler = DetectorSampler(
+                [DET_FILES['bwr{}'.format(d)] for d in (0, 1)])
+        self.assertFalse(any(detectorModule._BUFFER_POOL.values()))
+        for name, det in sampler.detectors.items():
+            self.assertIsNone(det.allTallies, msg=name)
+            assert_allclose(det.tallies, self.sampler[name].tallies,
+                            err_msg=name)
+
+    def test_freeRecycle(self):
+        """Verify a freed sampler's buffers are used by later samplers"""
+        self.addCleanup(SampledDetector.clearBufferPool)
+        SampledDetector.clearBufferPool()
+        files = [DET_FILES['bwr{}'.format(d)] for d in (0, 1)]
+        first = DetectorSampler(files)
+        buffers = {id(buffer) for det in first.detectors.values()
+                   for buffer in (det.allTallies, det.allErrors)}
+        first.free(recycle=True)
+        self.assertFalse(first.parsers)
+        for name, det in first.detectors.items():
+            self.assertIsNone(det.allTallies, msg=name)
+            assert_allclose(det.tallies, self.sampler[name].tallies,
+                            err_msg=name)
+        second = DetectorSampler(files)
+        self.assertTrue(buffers.intersection(
+            id(buffer) for det in second.detectors.values()
+            for buffer in (det.allTallies, det.allErrors)))
+        for name, det in second.detectors.items():
+            assert_allclose(det.tallies, self.sampler[name].tallies,
+                            err_msg=name)
+            assert_allclose(det.errors, self.sampler[name].errors,
+                            err_msg=name)
+
+    def test_setBeforeStatistics(self):
+        """Verify shapes are checked before statistics are computed"""
+        ref = self.sampler['spectrum']
+        sampled = SampledDetector('test', ref.allTallies, ref.allErrors)
+        with self.assertRaises(IndexError):
+            sampled.tallies = ref.tallies[1:]
+        with self.assertRaises(IndexError):
+            sampled.errors = ref.errors[1:]
+        with self.assertRaises(TypeError):
+            sampled.tallies = 1.0
+        self.assertIsNone(sampled._tallies)
+        newTallies = 2 * ref.tallies
+        sampled.tallies = newTallies
+        self.assertIs(sampled.tallies, newTallies)
+        assert_allclose(sampled.errors, ref.errors)
+
+    def test_setAllData(self):
+        """Verify shapes are checked when setting sampled data"""
+        ref = self.sampler['spectrum']
+        sampled = SampledDetector(
+            'test', ref.allTallies.copy(), ref.allErrors.copy())
+        newTallies = 2 * ref.allTallies
+        sampled.allTallies = newTallies
+        self.assertIs(sampled.allTallies, newTallies)
+        sampled.allErrors = ref.allErrors.tolist()
+        assert_allclose(sampled.allErrors, ref.allErrors)
+        with self.assertRaises(ValueError):
+            sampled.allTallies = newTallies[1:]
+        with self.assertRaises(ValueError):
+            sampled.allErrors = ref.allErrors[1:]
+
     def test_missingDetectors(self):
         """Verify that an error is raised if detectors are missing"""
         files = [getFile(fp)
@@ -103,6 +239,13 @@ class DetSamplerTester(TestCaseWithLogCapture):
         with self.assertRaises(MismatchedContainersError):
             DetectorSampler(files)
 
+    def test_detectorOrder(self):
+        """Verify detectors are stored in the order they are read"""
+        self.assertListEqual(list(self.sampler.detectors),
+                             list(self.singleReader.detectors))
+        self.assertListEqual([name for name, _ in self.sampler.iterDets()],
+                             list(self.singleReader.detectors))
+
     def test_getitem(self):
         """Verify the getitem method for retrieving detectors works."""
         for name, det in self.sampler.detectors.items():
@@ -112,8 +255,251 @@ class DetSamplerTester(TestCaseWithLogCapture):
             self.sampler['this should fail']
 
 
+class FromDetectorsTester(TestCaseWithLogCapture):
+    """Test the structure checks in SampledDetector.fromDetectors"""
+
+    @classmethod
+    def setUpClass(cls):
+        reader = DetectorReader(DET_FILES['bwr0'])
+        reader.read()
+        cls.detector = reader.detectors['spectrum']
+
+    def _copy(self, **kwargs):
+        ref = self.detector
+        attrs = {
+            'tallies': ref.tallies.copy(), 'errors': ref.errors.copy(),
+            'indexes': ref.indexes,
+            'grids': {k: v.copy() for k, v in ref.grids.items()}}
+        attrs.update(kwargs)
+        return Detector(ref.name, **attrs)
+
+    def test_identical(self):
+        """Verify no warnings are raised for identical grids"""
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            sampled = SampledDetector.fromDetectors(
+                'spectrum', [self.detector, self._copy()])
+        self.assertEqual(sampled.allTallies.shape,
+                         (2, ) + self.detector.tallies.shape)
+        assert_allclose(sampled.tallies, self.detector.tallies)
+
+    def test_dtype(self):
+        """Verify the storage type can be reduced"""
+        sampled = SampledDetector.fromDetectors(
+            'spectrum', [self.detector, self._copy()], dtype=float32)
+        self.assertIs(sampled.allTallies.dtype.type, float32)
+        self.assertIs(sampled.allErrors.dtype.type, float32)
+        assert_allclose(sampled.tallies, self.detector.tallies, rtol=1E-6)
+
+    def test_streaming(self):
+        """Verify the streaming construction matches the full sample"""
+        other = self._copy()
+        other.tallies *= 1.5
+        other.errors *= 0.5
+        full = SampledDetector.fromDetectors(
+            'spectrum', [self.detector, other])
+        stream = SampledDetector.fromDetectorsStreaming(
+            'spectrum', (d for d in [self.detector, other]))
+        self.assertIsNone(stream.allTallies)
+        self.assertIsNone(stream.allErrors)
+        self.assertEqual(stream.indexes, full.indexes)
+        assert_allclose(stream.tallies, full.tallies)
+        assert_allclose(stream.errors, full.errors)
+        assert_allclose(stream.deviation, full.deviation, rtol=1E-6)
+        with self.assertRaises(AttributeError):
+            stream.spreadPlot()
+        with self.assertRaises(ValueError):
+            SampledDetector.fromDetectorsStreaming('spectrum', iter([]))
+
+    def test_snapshot(self):
+        """Verify later changes to source detectors are not reflected"""
+        first = self._copy()
+        second = self._copy()
+        second.errors *= 2
+        expected = _getExpectedAverages(first, second)
+        sampled = SampledDetector.fromDetectors(
+            'spectrum', [first, second])
+        first.tallies *= 100
+        first.errors *= 100
+        assert_allclose(sampled.tallies, expected[0])
+        assert_allclose(sampled.errors, expected[1])
+
+    def test_takeOwnership(self):
+        """Verify incoming detector data are released if requested"""
+        first = self._copy()
+        second = self._copy()
+        second.errors *= 2
+        expected = _getExpectedAverages(first, second)
+        sampled = SampledDetector.fromDetectors(
+            'spectrum', [first, second], takeOwnership=True)
+        for d in (first, second):
+            self.assertIsNone(d.tallies)
+            self.assertIsNone(d.errors)
+        assert_allclose(sampled.tallies, expected[0])
+        assert_allclose(sampled.errors, expected[1])
+
+    def test_freeKeepsReferences(self):
+        """Verify arrays are not reused unless recycling is requested"""
+        first = SampledDetector.fromDetectors(
+            'spectrum', [self.detector, self._copy()])
+        kept = first.allTallies
+        expected = kept.copy()
+        first.free()
+        other = self._copy()
+        other.tallies *= 3
+        second = SampledDetector.fromDetectors(
+            'spectrum', [self.detector, other])
+        self.assertIsNot(second.allTallies, kept)
+        assert_allclose(kept, expected)
+
+    def test_freeReusesBuffers(self):
+        """Verify freed sample buffers are used by later detectors"""
+        self.addCleanup(SampledDetector.clearBufferPool)
+        SampledDetector.clearBufferPool()
+        first = SampledDetector.fromDetectors(
+            'spectrum', [self.detector, self._copy()])
+        buffers = {id(first.allTallies), id(first.allErrors)}
+        expected = first.allTallies.mean(axis=0)
+        first.free(recycle=True)
+        self.assertIsNone(first.allTallies)
+        self.assertIsNone(first.allErrors)
+        assert_allclose(first.tallies, expected)
+        second = SampledDetector.fromDetectors(
+            'spectrum', [self.detector, self._copy()])
+        self.assertSetEqual(
+            {id(second.allTallies), id(second.allErrors)}, buffers)
+        assert_allclose(second.tallies, expected)
+        second.free(recycle=True)
+        SampledDetector.clearBufferPool()
+        self.assertFalse(detectorModule._BUFFER_POOL)
+
+    def test_poolBounded(self):
+        """Verify the buffer pool retains a limited number of shapes"""
+        self.addCleanup(SampledDetector.clearBufferPool)
+        SampledDetector.clearBufferPool()
+        nShapes = detectorModule.MAX_POOLED_SHAPES + 1
+        for size in range(1, nShapes + 1):
+            tallies = self.detector.tallies[:size]
+            errors = self.detector.errors[:size]
+            detectors = [Detector('spectrum', tallies=tallies, errors=errors)
+                         for _ in range(2)]
+            SampledDetector.fromDetectors(
+                'spectrum', detectors).free(recycle=True)
+        pooledShapes = [shape for shape, _dtype in detectorModule._BUFFER_POOL]
+        self.assertEqual(len(pooledShapes), nShapes - 1)
+        self.assertNotIn((2, 1), pooledShapes)
+
+    def test_sharedGrids(self):
+        """Verify detectors sharing grids are sampled without checks"""
+        other = self._copy(grids=self.detector.grids)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            sampled = SampledDetector.fromDetectors(
+                'spectrum', [self.detector, other])
+        self.assertIs(sampled.grids, self.detector.grids)
+
+    def test_differentGrids(self):
+        """Verify a warning is raised for different grid values"""
+        other = self._copy()
+        other.grids['E'] *= 2
+        smaller = self._copy()
+        smaller.grids['E'] = smaller.grids['E'][1:]
+        for builder in self._builders():
+            for detector in (other, smaller):
+                with self.assertWarns(RuntimeWarning):
+                    builder('spectrum', [self.detector, detector])
+
+    def test_noIndexes(self):
+        """Verify detectors without indexes can be sampled"""
+        ref = self.detector
+        detectors = [Detector('spectrum', tallies=ref.tallies,
+                              errors=ref.errors) for _ in range(2)]
+        for builder in self._builders():
+            sampled = builder('spectrum', detectors)
+            self.assertIsNone(sampled.indexes)
+            assert_allclose(sampled.tallies, ref.tallies)
+
+    def test_badStructure(self):
+        """Verify errors are raised for inconsistent structures"""
+        ref = self.detector
+        for builder in self._builders():
+            with self.assertRaises(ValueError):
+                builder('spectrum', [])
+            with self.assertRaises(TypeError):
+                builder('spectrum', [ref, ref.tallies])
+            with self.assertRaises(ValueError):
+                builder('spectrum', [ref, self._copy(
+                    tallies=ref.tallies[1:], errors=ref.errors[1:])])
+            with self.assertRaises(KeyError):
+                builder('spectrum', [ref, self._copy(
+                    grids={'X': ref.grids['E']})])
+            with self.assertRaises(AttributeError):
+                builder('spectrum', [ref, self._copy(grids={})])
+
+    @staticmethod
+    def _builders():
+        return (SampledDetector.fromDetectors,
+                SampledDetector.fromDetectorsStreaming)
+
+
+@pytest.mark.skipif(not _detector_kernels.HAS_NUMBA,
+                    reason="numba required for compiled kernel")
+def test_compiledStatistics():
+    """Compare the compiled statistics kernel against numpy"""
+    rng = RandomState(20201015)
+    allTallies = rng.random_sample((5, 3, 4))
+    allTallies[:, 0, 0] = 0
+    allErrors = 0.01 * rng.random_sample(allTallies.shape)
+    tallies, errors, deviation = _detector_kernels.sampleStatistics(
+        allTallies, allErrors)
+    expTallies = allTallies.mean(axis=0)
+    expErrors = sqrt(square(allErrors).sum(axis=0)) / allTallies.shape[0]
+    expErrors[1:] /= expTallies[1:]
+    expErrors[0, 1:] /= expTallies[0, 1:]
+    assert_allclose(tallies, expTallies)
+    assert_allclose(errors, expErrors)
+    assert_allclose(deviation, allTallies.std(axis=0))
+
+
+@pytest.mark.skipif(not _detector_kernels.HAS_NUMBA,
+                    reason="numba required for compiled kernel")
+def test_fromDetectorsUsesKernel(monkeypatch):
+    """Verify sampling large detectors dispatches to the compiled kernel"""
+    calls = []
+
+    def countCalls(allTallies, allErrors):
+        calls.append(allTallies.shape)
+        return _detector_kernels.sampleStatistics(allTallies, allErrors)
+
+    monkeypatch.setattr(detectorModule, "sampleStatistics", countCalls)
+    rng = RandomState(20201015)
+    nBins = _detector_kernels.MIN_COMPILED_BINS
+    detectors = [
+        Detector('large', tallies=rng.random_sample(nBins),
+                 errors=0.01 * rng.random_sample(nBins), indexes=('x', ))
+        for _ in range(3)]
+    sampled = SampledDetector.fromDetectors('large', detectors)
+    allTallies = sampled.allTallies
+    assert_allclose(sampled.tallies, allTallies.mean(axis=0))
+    assert_allclose(sampled.deviation, allTallies.std(axis=0))
+    assert calls == [(3, nBins)]
+
+    small = [Detector('small', tallies=d.tallies[:10], errors=d.errors[:10],
+                      indexes=('x', )) for d in detectors]
+    assert_allclose(SampledDetector.fromDetectors('small', small).tallies,
+                    allTallies[:, :10].mean(axis=0))
+    assert len(calls) == 1
+
+
 def _getExpectedAverages(d0, d1):
     tallies = 0.5 * (d0.tallies + d1.tallies)
     errors = 0.5 * sqrt(square(d0.errors) + square(d1.errors))
 
     return tallies, errors
+
+
+def test_numbaImportedLazily():
+    """Verify importing the package does not import numba"""
+    script = "import sys, serpentTools; print('numba' in sys.modules)"
+    output = subprocess.check_output([sys.executable, "-c", script])
+    assert output.strip() == b"False"